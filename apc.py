@@ -2,18 +2,317 @@ import aiochclient
 import aiohttp
 import asyncio
 import colorlog
+import dataclasses
 import datetime
-import ujson as json
 import logging
+import math
+import orjson
 import os
 import re
 import signal
+import ssl
 import sys
+import time
 import uvloop
+import warnings
 uvloop.install()
 
 log = logging.getLogger('APC')
 
+# OID groups to GETBULK
+# Have to batch them since it exceeds the max packet size
+UPS_OIDS = (
+    ('.1.3.6.1.4.1.318.1.1.1.1.2', '.1.3.6.1.4.1.318.1.1.1.2.2', '.1.3.6.1.4.1.318.1.1.1.2.3', '.1.3.6.1.4.1.318.1.1.1.4.2', '.1.3.6.1.4.1.318.1.1.1.1.1.1'),
+    ('.1.3.6.1.4.1.318.1.1.1.3.3', '.1.3.6.1.4.1.318.1.1.1.4.3', '.1.3.6.1.4.1.318.1.1.1.12.1', '.1.3.6.1.4.1.318.1.1.1.5.2'),
+)
+PROBE_OIDS = (
+    ('.1.3.6.1.4.1.318.1.1.25.1',),
+)
+
+# Output power OIDs and the target rating used to calculate them if the UPS doesn't provide them
+OUTPUT_POWER_OIDS = (
+    ('upsAdvOutputActivePower.0', 'rated_watts'), # Output watts
+    ('upsAdvOutputApparentPower.0', 'rated_va'), # Output VA
+)
+
+# High precision OIDs, in insert order, with the divisor and minimum value to apply to them (-inf for no minimum)
+HIGH_PRECISION_OIDS = (
+    ('upsHighPrecBatteryCapacity.0', 10, -math.inf), # Battery capacity : upsHighPrecBatteryCapacity.0 = 1000
+    ('upsHighPrecBatteryActualVoltage.0', 10, -math.inf), # Battery voltage : upsHighPrecBatteryActualVoltage.0 = 1330
+    ('upsHighPrecInputLineVoltage.0', 10, -math.inf), # Input voltage : upsHighPrecInputLineVoltage.0 = 1190
+    ('upsHighPrecInputFrequency.0', 10, -math.inf), # Input frequency : upsHighPrecInputFrequency.0 = 600
+    ('upsHighPrecOutputVoltage.0', 10, -math.inf), # Output voltage : upsHighPrecOutputVoltage.0 = 1196
+    ('upsHighPrecOutputFrequency.0', 10, -math.inf), # Output frequency : upsHighPrecOutputFrequency.0 = 600
+    ('upsHighPrecOutputLoad.0', 10, -math.inf), # Output load percent : upsHighPrecOutputLoad.0 = 68
+    ('upsHighPrecOutputCurrent.0', 10, -math.inf), # Output current amps : upsHighPrecOutputCurrent.0 = 12
+    ('upsHighPrecOutputEfficiency.0', 10, 0.0), # Output efficiency percent : upsHighPrecOutputEfficiency.0 = -2 (this one is weird, it can go negative)
+    ('upsHighPrecOutputEnergyUsage.0', 100, -math.inf), # Output energy usage kWh : upsHighPrecOutputEnergyUsage.0 = 340
+)
+
+# Seconds in each days:hours:minutes:seconds timeticks field
+TIMETICKS_WEIGHTS = (86400, 3600, 60, 1)
+
+# NMC session regex, the URLs are always ASCII
+NMC_SESSION_REGEX = re.compile(r'/NMC/(.*)/', re.ASCII)
+
+# (offset, multiplier, divisor) to convert a probe temperature unit to Celsius
+# Multiplying then dividing keeps the values identical to (F - 32) * 5 / 9, a premultiplied 5 / 9 rounds differently
+TEMPERATURE_TO_CELSIUS = {
+    b'F': (32.0, 5, 9),
+    b'C': (0.0, 1, 1),
+}
+
+# Regex to check if it's the NMC login page, matched against the raw page bytes
+PROBE_HTML_LOGIN_REGEX = re.compile(rb'<span class="h3 text-primary">\nLogin<\/span>')
+
+# uiostatus.htm markup surrounding each probe row
+# The page is scanned as bytes so it never has to be decoded
+PROBE_HTML_ROW = b'<a href="uiocfg.htm?sensor='
+PROBE_HTML_STATUS = b'</a></td>\r\n<td><span class="se-icon-f4-selection text-success"></span>&nbsp;Normal</td>\r\n<td>'
+PROBE_HTML_DEGREES = b'&deg;&nbsp;'
+PROBE_HTML_CELL = b'</td>\r\n<td>'
+PROBE_HTML_HUMIDITY = b'%&nbsp;RH'
+PROBE_HTML_ROW_END = b'</td>\r\n</tr>'
+# The probe table ends where the input contacts section starts
+PROBE_HTML_END = b'<span id="langInputContacts">'
+# Pages at least this big are parsed in a thread instead of on the event loop
+PROBE_HTML_EXECUTOR_SIZE = 64 * 1024
+
+
+def _scale_high_precision(snmp_data):
+    """
+        Scales the high precision values in HIGH_PRECISION_OIDS order
+
+        Returns a tuple with None for the values the UPS didn't provide
+    """
+    return tuple(
+        max(minimum, float(value) / divisor) if (value := snmp_data.get(key)) else None
+        for key, divisor, minimum in HIGH_PRECISION_OIDS
+    )
+
+
+def _parse_apc_date(key, date):
+    """
+        Parses an APC date into a datetime.date object
+
+        upsAdvBatteryRecommendedReplaceDate.0 = "05/16/2027" or "03/07/22"
+        Returns None if there's no date or it fails to parse
+    """
+    if date is None:
+        return None
+    try:
+        month, day, year = date.split('/')
+        # Only accept what strptime's %m/%d/%Y and %m/%d/%y did, int() alone allows things like "+3" or a 3 digit year
+        if not (
+            len(month) in (1, 2) and len(day) in (1, 2) and len(year) in (2, 4)
+            and (digits := month + day + year).isascii() and digits.isdigit()
+        ):
+            raise ValueError('expected an MM/DD/YYYY or MM/DD/YY date')
+        # Two digit years use the same cutoff as strptime's %y (69-99 is 19XX)
+        if len(year) == 2:
+            year = int(year)
+            year += 1900 if year >= 69 else 2000
+        return datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        log.exception('Failed to parse %s "%s"', key, date)
+        return None
+
+
+def _parse_timeticks(timeticks):
+    """
+        Parses a days:hours:minutes:seconds timeticks string into seconds
+
+        upsAdvBatteryRunTimeRemaining.0 = 0:3:01:24.00
+        Returns None if there's no value
+    """
+    if timeticks is None:
+        return None
+    parts = timeticks.split(':', 3)
+    # Drop the hundredths of a second
+    parts[3] = parts[3][:2]
+    return sum(int(part) * weight for part, weight in zip(parts, TIMETICKS_WEIGHTS))
+
+
+def _parse_probe_html(html):
+    """
+        Parses the probes from uiostatus.htm
+
+        Scans the raw page bytes with bytes.find so it's a single linear pass over the HTML
+        Returns a list of (name, temperature, unit, humidity) tuples,
+        the name is decoded and the rest are left as bytes (float() accepts them),
+        humidity is empty if the probe doesn't report it
+    """
+    probes = []
+    # Only look at the probe table
+    end = html.find(PROBE_HTML_END)
+    if end == -1:
+        end = len(html)
+
+    pos = html.find(PROBE_HTML_ROW, 0, end)
+    while pos != -1:
+        # Probe name : <a href="uiocfg.htm?sensor=0" alt="Edit" title="Edit">Port 1 Temp 1</a>
+        name_start = html.find(b'>', pos, end) + 1
+        name_end = html.find(b'</a>', name_start, end)
+        if not name_start or name_end == -1:
+            break
+        pos = html.find(PROBE_HTML_ROW, name_end, end)
+        # Don't let a malformed row run into the next one
+        row_end = end if pos == -1 else pos
+
+        # Skip probes that aren't in the "Normal" status
+        if not html.startswith(PROBE_HTML_STATUS, name_end):
+            continue
+
+        # Temperature : 70.5&deg;&nbsp;F
+        temp_start = name_end + len(PROBE_HTML_STATUS)
+        temp_end = html.find(PROBE_HTML_DEGREES, temp_start, row_end)
+        if temp_end == -1:
+            continue
+        temperature = html[temp_start:temp_end]
+        # Skip probes without a numeric temperature
+        if not temperature.removeprefix(b'-').replace(b'.', b'', 1).isdigit():
+            continue
+        unit_start = temp_end + len(PROBE_HTML_DEGREES)
+        unit = html[unit_start:unit_start + 1]
+        if unit not in TEMPERATURE_TO_CELSIUS or not html.startswith(PROBE_HTML_CELL, unit_start + 1):
+            continue
+
+        # Humidity : 40%&nbsp;RH or Not Available
+        humidity_start = unit_start + 1 + len(PROBE_HTML_CELL)
+        humidity_end = html.find(PROBE_HTML_ROW_END, humidity_start, row_end)
+        if humidity_end == -1:
+            continue
+        humidity = html[humidity_start:humidity_end]
+        if humidity.endswith(PROBE_HTML_HUMIDITY):
+            humidity = humidity[:-len(PROBE_HTML_HUMIDITY)]
+            # Humidity is always 1 or 2 digits
+            if not (len(humidity) <= 2 and humidity.isdigit()):
+                continue
+        elif humidity == b'Not Available':
+            humidity = b''
+        else:
+            continue
+
+        probes.append((html[name_start:name_end].decode('utf-8', 'replace'), temperature, unit, humidity))
+
+    return probes
+
+
+class PingPongBuffer:
+    """
+        Double buffer of rows waiting to be inserted into ClickHouse
+
+        Fetchers append rows to the active buffer, the inserter swaps it
+        with the idle buffer and inserts all of its rows at once
+    """
+    def __init__(self, capacity:int):
+        # Max number of rows in the active buffer
+        self.capacity = capacity
+        self._active = []
+        self._idle = []
+        # Set when the active buffer has rows
+        self._has_rows = asyncio.Event()
+        # Set when the active buffer is full
+        self._full = asyncio.Event()
+        # Set when the active buffer has room for more rows
+        self._has_room = asyncio.Event()
+        self._has_room.set()
+        # Set when the buffer is closed for shutdown
+        self._closed = False
+        # Set once a put has had to wait for a swap, so a stall is only warned about once
+        self._stalled = False
+
+    def __len__(self):
+        return len(self._active)
+
+    async def put(self, row):
+        """
+            Adds a row to the active buffer, waiting for a swap if it's full
+        """
+        while len(self._active) >= self.capacity and not self._closed:
+            # Fetchers miss their deadlines while waiting here, so make the stall visible
+            if not self._stalled:
+                self._stalled = True
+                log.warning('ClickHouse queue is full (%s rows), fetches are waiting for inserts to catch up', len(self._active))
+            await self._has_room.wait()
+        # Drop rows added after shutdown
+        if self._closed:
+            return
+        self._active.append(row)
+        self._has_rows.set()
+        if len(self._active) >= self.capacity:
+            self._full.set()
+            self._has_room.clear()
+
+    async def swap(self, timeout:float) -> list | None:
+        """
+            Waits for rows and swaps the buffers, returning the filled one
+
+            Waits up to timeout seconds for the active buffer to fill up first
+            The returned buffer is reused on the next swap
+            Returns None once the buffer is closed and has no rows left
+        """
+        await self._has_rows.wait()
+        try:
+            await asyncio.wait_for(self._full.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        if self._closed and not self._active:
+            return None
+
+        rows = self._active
+        self._idle.clear()
+        self._active = self._idle
+        self._idle = rows
+
+        # Keep the events set once closed so the remaining rows are taken without waiting
+        if not self._closed:
+            self._has_rows.clear()
+            self._full.clear()
+        self._has_room.set()
+        self._stalled = False
+        return rows
+
+    def close(self):
+        """
+            Closes the buffer for shutdown
+
+            New rows are dropped and swap returns None once the remaining rows are taken
+        """
+        self._closed = True
+        self._has_rows.set()
+        self._full.set()
+        self._has_room.set()
+
+
+@dataclasses.dataclass(slots=True)
+class UPS:
+    """
+        UPS target parsed from targets.json
+    """
+    name:str # UPS name
+    ip:str # UPS IP
+    sku:str | None # UPS SKU
+    rated_va:int | None # UPS rated VA
+    rated_watts:int | None # UPS rated watts
+    snmp_version:str # SNMP version
+    snmp_community:str | None # SNMP community (v2c)
+    snmp_username:str | None # SNMP username (v3)
+    snmp_password:str | None # SNMP password (v3)
+    snmp_port:int # SNMP port
+    interval:int | None # Fetch interval
+    timeout:int | None # SNMP fetch timeout
+    fetch_probes:str | bool # False, snmp, http, or https (scraping the web interface for more precise data)
+    http_username:str | None # HTTP username
+    http_password:str | None # HTTP password
+    http_port:int | None # HTTP port
+    snmp_args:tuple = () # Used internally for the snmpbulkget arguments
+    nmc_session:str | None = None # Used internally for saving NMC session
+    probe_url:str | None = None # Used internally for the uiostatus.htm URL with the NMC session
+    http_timeout:aiohttp.ClientTimeout | None = None # Used internally for the NMC web interface request timeout
+    session:aiohttp.ClientSession | None = None # Used internally for the NMC web interface ClientSession
+
 
 class APC:
     def __init__(self, loop):
@@ -22,27 +321,40 @@ class APC:
         # Load environment variables
         self._load_env_vars()
 
-        # NMC session regex
-        self.nmc_session_regex = re.compile(
-            r'/NMC/(.*)/'
-        )
-
-        # Probe HTML regex
-        self.probe_html_regex = re.compile(
-            r'<a href=\"uiocfg\.htm\?sensor=[\d]{1}\" alt=\"Edit\" title=\"Edit\">([^<]*)</a></td>\r\n<td><span class=\"se-icon-f4-selection text-success\"></span>&nbsp;Normal</td>\r\n<td>([^&]*)&deg;&nbsp;(F|C)</td>\r\n<td>(?:([\d]{1,2})%&nbsp;RH|Not Available)</td>\r\n</tr>\r\n(?=<tr>|</table>\n</div>\n</div>\n<div class=\"dataSection\">\n<div class=\"dataSubHeader\">\n<span id=\"langInputContacts\">)'
-        )
-        # Regex to check if it's the NMC login page
-        self.probe_html_login_regex = re.compile(
-            r'<span class="h3 text-primary">\nLogin<\/span>'
-        )
+        # SSL context for the NMC web interface
+        # NMCs use self-signed certificates and old TLS versions/ciphers
+        self.nmc_ssl_context = ssl.create_default_context()
+        self.nmc_ssl_context.check_hostname = False
+        self.nmc_ssl_context.verify_mode = ssl.CERT_NONE
+        # TLSv1 is deprecated (and warns on every startup), but older NMCs don't support anything newer
+        # Clearing OP_NO_TLSv1 isn't enough since the default context's minimum_version is TLSv1.2
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', 'ssl.TLSVersion.TLSv1 is deprecated', DeprecationWarning)
+            self.nmc_ssl_context.minimum_version = ssl.TLSVersion.TLSv1
+        self.nmc_ssl_context.set_ciphers('DEFAULT:@SECLEVEL=0')
 
         # Get the event loop
         self.loop = loop
 
         self.ups_targets = []
 
+        # ClickHouse INSERT query, built once since the table never changes
+        self.clickhouse_insert_query = f"""
+            INSERT INTO {self.clickhouse_table} (
+                name, model, sku, sensitivity, status, last_transfer_reason, battery_needs_replacement,
+                battery_status, output_load_watts, output_load_va, battery_capacity_percent, battery_voltage,
+                input_voltage, input_frequency, output_voltage, output_frequency,
+                output_load_percent, output_current_amps, output_efficiency_percent, output_energy_usage_kwh,
+                manufacture_date, battery_last_replace_date, battery_next_replace_date, runtime_remaining_seconds,
+                on_battery_seconds, sensor_name, sensor_value, time
+            ) VALUES
+            """
+
+        # Semaphore limiting how many UPSes are being fetched at once
+        self.fetch_semaphore = asyncio.Semaphore(self.fetch_concurrency)
+
         # Queue of data waiting to be inserted into ClickHouse
-        self.clickhouse_queue = asyncio.Queue(maxsize=self.clickhouse_queue_limit)
+        self.clickhouse_queue = PingPongBuffer(self.clickhouse_queue_limit)
 
         # Event used to stop the loop
         self.stop_event = asyncio.Event()
@@ -77,66 +389,66 @@ class APC:
 
     def _load_targets(self):
         # Open and read the targets file
-        with open('targets.json', 'r') as file:
+        with open('targets.json', 'rb') as file:
             try:
-                targets = json.loads(file.read())
+                targets = orjson.loads(file.read())
             except Exception as e:
-                log.error(f'Failed to read targets.json: "{e}"')
+                log.error('Failed to read targets.json: "%s"', e)
                 exit(1)
 
         # Parse targets
         for target in targets:
             try:
                 if (snmp_version := target['snmp_version'].lower()) not in ('v2c', 'v3'):
-                    log.error(f'Invalid snmp_version "{target["snmp_version"]}" for target "{target["name"]}"')
+                    log.error('Invalid snmp_version "%s" for target "%s"', target['snmp_version'], target['name'])
                     continue
                 
                 if target['snmp_version'] == 'v2c' and not target.get('snmp_community'):
-                    log.error(f'Missing snmp_community for target "{target["name"]}"')
+                    log.error('Missing snmp_community for target "%s"', target['name'])
                     continue
                 
                 if target['snmp_version'] == 'v3' and (not target.get('snmp_username') or not target.get('snmp_password')):
-                    log.error(f'Missing snmp_username/snmp_password for target "{target["name"]}"')
+                    log.error('Missing snmp_username/snmp_password for target "%s"', target['name'])
                     continue
 
-                if (snmp_port := target.get('port', 161)):
+                if (snmp_port := target.get('snmp_port', 161)):
                     try:
                         snmp_port = int(snmp_port)
                     except ValueError:
-                        log.error(f'Invalid snmp_port "{snmp_port}" for target "{target["name"]}"')
+                        log.error('Invalid snmp_port "%s" for target "%s"', snmp_port, target['name'])
                         continue
 
                 if (interval := target.get('interval', self.fetch_interval)):
                     try:
                         interval = int(interval)
                     except ValueError:
-                        log.error(f'Invalid interval "{interval}" for target "{target["name"]}"')
+                        log.error('Invalid interval "%s" for target "%s"', interval, target['name'])
                         continue
 
                 if (timeout := target.get('timeout', self.fetch_timeout)):
                     try:
                         timeout = int(timeout)
                     except ValueError:
-                        log.error(f'Invalid timeout "{timeout}" for target "{target["name"]}"')
+                        log.error('Invalid timeout "%s" for target "%s"', timeout, target['name'])
                         continue
                 
                 if (fetch_probes := target.get('fetch_probes', 'off').lower()):
                     if fetch_probes == 'off':
                         fetch_probes = False
                     elif fetch_probes not in ('snmp', 'http', 'https'):
-                        log.error(f'Invalid fetch_probes value "{fetch_probes}" for target "{target["name"]}"')
+                        log.error('Invalid fetch_probes value "%s" for target "%s"', fetch_probes, target['name'])
                         continue
 
                 if fetch_probes in ('http', 'https'):
                     if not target.get('http_username') or not target.get('http_password'):
-                        log.error(f'Missing http_username/http_password for target "{target["name"]}"')
+                        log.error('Missing http_username/http_password for target "%s"', target['name'])
                         continue
 
                 if (http_port := target.get('http_port')):
                     try:
                         http_port = int(http_port)
                     except ValueError:
-                        log.error(f'Invalid http_port "{http_port}" for target "{target["name"]}"')
+                        log.error('Invalid http_port "%s" for target "%s"', http_port, target['name'])
                         continue
                 elif fetch_probes == 'http':
                     http_port = 80
@@ -147,51 +459,113 @@ class APC:
                     try:
                         rated_va = int(rated_va)
                     except ValueError:
-                        log.error(f'Invalid rated_va value "{rated_va}" for target "{target["name"]}"')
+                        log.error('Invalid rated_va value "%s" for target "%s"', rated_va, target['name'])
                         continue
                 
                 if (rated_watts := target.get('rated_watts')):
                     try:
                         rated_watts = int(rated_watts)
                     except ValueError:
-                        log.error(f'Invalid rated_watts value "{rated_watts}" for target "{target["name"]}"')
+                        log.error('Invalid rated_watts value "%s" for target "%s"', rated_watts, target['name'])
                         continue
 
-                self.ups_targets.append({
-                    'name': target['name'], # UPS name
-                    'ip': target['ip'], # UPS IP
-                    'sku': target.get('sku'), # UPS SKU
-                    'rated_va': rated_va, # UPS rated VA
-                    'rated_watts': rated_watts, # UPS rated watts
-                    'snmp_version': snmp_version, # SNMP version
-                    'snmp_community': target.get('snmp_community'), # SNMP community (v2c)
-                    'snmp_username': target.get('snmp_username'), # SNMP username (v3)
-                    'snmp_password': target.get('snmp_password'), # SNMP password (v3)
-                    'snmp_port': snmp_port, # SNMP port
-                    'interval': interval, # Fetch interval
-                    'timeout': timeout, # SNMP fetch timeout
-                    'fetch_probes': fetch_probes, # off, snmp, http, or https (scraping the web interface for more precise data)
-                    'http_username': target.get('http_username'), # HTTP username
-                    'http_password': target.get('http_password'), # HTTP password
-                    'http_port': http_port, # HTTP port
-                    'nmc_session': None # Used internally for saving NMC session
-                })
-                log.debug(f'Parsed UPS target "{target["name"]}" at IP "{target["ip"]}"')
+                ups = UPS(
+                    name=target['name'], # UPS name
+                    ip=target['ip'], # UPS IP
+                    sku=target.get('sku'), # UPS SKU
+                    rated_va=rated_va, # UPS rated VA
+                    rated_watts=rated_watts, # UPS rated watts
+                    snmp_version=snmp_version, # SNMP version
+                    snmp_community=target.get('snmp_community'), # SNMP community (v2c)
+                    snmp_username=target.get('snmp_username'), # SNMP username (v3)
+                    snmp_password=target.get('snmp_password'), # SNMP password (v3)
+                    snmp_port=snmp_port, # SNMP port
+                    interval=interval, # Fetch interval
+                    timeout=timeout, # SNMP fetch timeout
+                    fetch_probes=fetch_probes, # off, snmp, http, or https (scraping the web interface for more precise data)
+                    http_username=target.get('http_username'), # HTTP username
+                    http_password=target.get('http_password'), # HTTP password
+                    http_port=http_port # HTTP port
+                )
+                # snmpbulkget arguments, used internally for fetching SNMP data
+                ups.snmp_args = self._build_snmp_args(ups)
+                # NMC web interface timeout, built once instead of on every request
+                ups.http_timeout = aiohttp.ClientTimeout(total=ups.timeout or self.fetch_timeout)
+                self.ups_targets.append(ups)
+                log.debug('Parsed UPS target "%s" at IP "%s"', target['name'], target['ip'])
             except KeyError as e:
-                log.error(f'Missing required key "{e.args[0]}" for UPS target "{target["name"]}"')
+                log.error('Missing required key "%s" for UPS target "%s"', e.args[0], target['name'])
             except Exception:
-                log.exception(f'Failed to parse UPS target {target}')
+                log.exception('Failed to parse UPS target %s', target)
+
+        # Reuse the NMC sessions from the last run
+        self._load_nmc_sessions()
+
+    def _load_nmc_sessions(self):
+        """
+            Loads the saved NMC sessions from NMC_SESSION_FILE
+
+            Stale sessions are regenerated on the first fetch like any other invalid session
+        """
+        if not self.nmc_session_file:
+            return
+        try:
+            with open(self.nmc_session_file, 'rb') as file:
+                sessions = orjson.loads(file.read())
+        except FileNotFoundError:
+            log.debug('No saved NMC sessions found at "%s"', self.nmc_session_file)
+            return
+        except Exception as e:
+            log.error('Failed to read saved NMC sessions from "%s": "%s"', self.nmc_session_file, e)
+            return
+        # The file has to be a {"UPS name": "session"} object
+        if not isinstance(sessions, dict):
+            log.error('Failed to read saved NMC sessions from "%s": "Expected a JSON object, got %s"', self.nmc_session_file, type(sessions).__name__)
+            return
+
+        for ups in self.ups_targets:
+            if ups.fetch_probes in ('http', 'https') and isinstance(session := sessions.get(ups.name), str) and session:
+                self._set_nmc_session(ups, session, save=False)
+                log.info('Loaded saved NMC session "%s" for UPS "%s" at IP "%s"', session, ups.name, ups.ip)
+
+    def _save_nmc_sessions(self):
+        """
+            Saves the current NMC sessions to NMC_SESSION_FILE
+        """
+        sessions = {ups.name: ups.nmc_session for ups in self.ups_targets if ups.nmc_session is not None}
+        try:
+            # Write to a temporary file and swap it in so a crash can't leave a partial file behind
+            # The sessions grant access to the NMC web interface, so only we can read the file
+            fd = os.open(f'{self.nmc_session_file}.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # The mode only applies when the file is created, so also fix a leftover temporary file
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'wb') as file:
+                file.write(orjson.dumps(sessions))
+            os.replace(f'{self.nmc_session_file}.tmp', self.nmc_session_file)
+        except Exception as e:
+            log.error('Failed to save NMC sessions to "%s": "%s"', self.nmc_session_file, e)
 
     def _load_env_vars(self):
         """
             Loads environment variables
         """
-        # Max number of inserts waiting to be inserted at once
+        # Max number of rows waiting to be inserted at once, also the max insert batch size
         try:
             self.clickhouse_queue_limit = int(os.environ.get('CLICKHOUSE_QUEUE_LIMIT', 50))
         except ValueError:
             log.exception('Invalid CLICKHOUSE_QUEUE_LIMIT passed, must be a number')
             exit(1)
+        # The buffer needs room for at least one row or puts would never finish
+        if self.clickhouse_queue_limit < 1:
+            log.error('Invalid CLICKHOUSE_QUEUE_LIMIT passed, must be at least 1')
+            exit(1)
+
+        # Max number of seconds to wait for a batch to fill before inserting it
+        try:
+            self.clickhouse_batch_timeout = float(os.environ.get('CLICKHOUSE_BATCH_TIMEOUT', 2))
+        except ValueError:
+            log.exception('Invalid CLICKHOUSE_BATCH_TIMEOUT passed, must be a number')
+            exit(1)
 
         # Default global SNMP fetch interval
         try:
@@ -207,6 +581,17 @@ class APC:
             log.exception('Invalid FETCH_TIMEOUT passed, must be a number')
             exit(1)
 
+        # Max number of UPSes to fetch at once
+        try:
+            self.fetch_concurrency = int(os.environ.get('FETCH_CONCURRENCY', 32))
+        except ValueError:
+            log.exception('Invalid FETCH_CONCURRENCY passed, must be a number')
+            exit(1)
+        # A semaphore of 0 would block every fetch forever
+        if self.fetch_concurrency < 1:
+            log.error('Invalid FETCH_CONCURRENCY passed, must be at least 1')
+            exit(1)
+
         # Log level to use
         # 10/debug  20/info  30/warning  40/error
         try:
@@ -225,350 +610,279 @@ class APC:
             self.clickhouse_pass = os.environ['CLICKHOUSE_PASS']
             self.clickhouse_db = os.environ['CLICKHOUSE_DB']
         except KeyError as e:
-            log.error(f'Missing required environment variable "{e.args[0]}"')
+            log.error('Missing required environment variable "%s"', e.args[0])
             exit(1)
         self.clickhouse_table = os.environ.get('CLICKHOUSE_TABLE', 'apc_ups')
 
+        # File to save NMC sessions to so they're reused across restarts (disabled if not set)
+        self.nmc_session_file = os.environ.get('NMC_SESSION_FILE')
+
     async def insert_to_clickhouse(self):
         """
             Gets data from the data queue and inserts it into ClickHouse
         """
-        while True:
-            # Get and check data from the queue
-            if not (data := await self.clickhouse_queue.get()):
-                continue
+        # Insert batches until the queue is closed and empty
+        while (batch := await self.clickhouse_queue.swap(self.clickhouse_batch_timeout)) is not None:
+            await self._insert_batch(batch)
+        log.debug('Finished inserting queued data into ClickHouse')
 
-            # Keep trying until the insert succeeds
-            while True:
-                try:
-                    # Insert the data into ClickHouse
-                    log.debug(f'Got data to insert: {data}')
-                    await self.clickhouse.execute(
-                        f"""
-                        INSERT INTO {self.clickhouse_table} (
-                            name, model, sku, sensitivity, status, last_transfer_reason, battery_needs_replacement,
-                            battery_status, output_load_watts, output_load_va, battery_capacity_percent, battery_voltage,
-                            input_voltage, input_frequency, output_voltage, output_frequency,
-                            output_load_percent, output_current_amps, output_efficiency_percent, output_energy_usage_kwh,
-                            manufacture_date, battery_last_replace_date, battery_next_replace_date, runtime_remaining_seconds,
-                            on_battery_seconds, sensor_name, sensor_value, time
-                        ) VALUES
-                        """,
-                        data
-                    )
-                    log.debug(f'Inserted data for timestamp {data[-1]}')
-                    # Insert succeeded, break the loop and move on
+    async def _insert_batch(self, batch):
+        """
+            Inserts a batch of rows into ClickHouse, retrying until it succeeds
+
+            Gives up after a failed insert if we're shutting down
+        """
+        # Keep trying until the insert succeeds
+        while True:
+            try:
+                # Insert the batch into ClickHouse
+                log.debug('Got %s rows to insert: %s', len(batch), batch)
+                await self.clickhouse_execute(self.clickhouse_insert_query, *batch)
+                log.debug('Inserted %s rows for timestamps %s to %s', len(batch), batch[0][-1], batch[-1][-1])
+                # Insert succeeded, break the loop and move on
+                break
+            except Exception as e:
+                # Insertion failed
+                log.error('Insert failed for %s rows for timestamps %s to %s: "%s"', len(batch), batch[0][-1], batch[-1][-1], e)
+                # Don't hold up shutdown retrying
+                if self.stop_event.is_set():
+                    log.error('Dropping %s rows since we\'re shutting down', len(batch))
                     break
-                except Exception as e:
-                    # Insertion failed
-                    log.error(f'Insert failed for timestamp {data[-1]}: "{e}"')
-                    # Wait before retrying so we don't spam retries
-                    await asyncio.sleep(2)
+                # Wait before retrying so we don't spam retries
+                await asyncio.sleep(2)
+
+    def _build_snmp_args(self, ups) -> tuple:
+        """
+            Builds the snmpbulkget arguments for a UPS target
 
-    async def fetch_snmp(self, ip, version, oids, community:str='', username:str='', password:str='', port:int=161, timeout:int=15) -> dict:
+            These never change for a target, so they're only built once
+        """
         args = ['snmpbulkget']
-        if version == 'v2c':
+        if ups.snmp_version == 'v2c':
             args.extend([
                 '-v2c',
-                '-c', community
+                '-c', ups.snmp_community
             ])
         else:
             args.extend([
                 '-v3',
-                '-u', username,
-                '-A', password,
+                '-u', ups.snmp_username,
+                '-A', ups.snmp_password,
             ])
         args.extend([
-            '-t', f'{timeout or self.fetch_timeout}', # Get timeout
+            '-t', f'{ups.timeout or self.fetch_timeout}', # Get timeout
             '-r', '0', # No retries
             '-m', './powernet.mib', # Use the Powernet MIB
             '-Oqs', # Output format: OID, type, value,
-            ip # UPS NMC IP
+            # UPS NMC IP, only add the port if it's not the default so plain IPv6 addresses keep working
+            ups.ip if ups.snmp_port == 161 else f'{ups.ip}:{ups.snmp_port}'
         ])
+        return tuple(args)
+
+    async def fetch_snmp(self, ups, oids) -> dict:
+        # Run a snmpbulkget for each OID group at the same time
+        results = await asyncio.gather(*(self._bulkget(ups.snmp_args, oid_group, ups.ip) for oid_group in oids))
+        # Check for errors
+        if None in results:
+            return {}
+
+        snmp_data = {}
+        for result in results:
+            snmp_data.update(result)
+
+        return snmp_data
+
+    async def _bulkget(self, args, oid_group, ip):
+        """
+            Runs a single snmpbulkget for an OID group and parses the output
+        """
+        # Run the snmpbulkget command
+        proc = await asyncio.create_subprocess_exec(
+            *args, *oid_group,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+
+        # SNMP data
+        # Parse the output line by line as snmpbulkget writes it
         snmp_data = {}
+        async for line in proc.stdout:
+            # Split the OID from the value
+            oid, _, value = line.rstrip(b'\r\n').partition(b' ')
+            # Strip the quotes and only decode what we keep
+            snmp_data[oid.decode('ascii')] = value.strip(b'"').decode('utf-8', 'replace')
 
-        # Iterate through and parse the OIDs
-        for oid in oids:
-            # Run the snmpbulkget command
-            proc = await asyncio.create_subprocess_exec(
-                *args + oid.split(),
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            # Wait for the command to finish
-            stdout, stderr = await proc.communicate()
-            # Check for errors
-            if proc.returncode != 0:
-                log.error(f'snmpbulkget exited with code {proc.returncode} for UPS {ip}')
-                return {}
-
-            # SNMP data
-            for line in stdout.decode().splitlines():
-                line = line.split(' ')
-                # Get the OID
-                oid = line[0]
-                # Get the value and join it back together if it was split
-                value = ' '.join(line[1:])
-                snmp_data[oid] = value.lstrip('"').rstrip('"')
+        # Wait for the command to finish and check for errors
+        if await proc.wait() != 0:
+            log.error('snmpbulkget exited with code %s for UPS %s', proc.returncode, ip)
+            return
 
         return snmp_data
     
     async def generate_nmc_session(self, ups):
-        log.info(f'Generating NMC session for UPS "{ups["name"]}" at IP "{ups["ip"]}"')
+        log.info('Generating NMC session for UPS "%s" at IP "%s"', ups.name, ups.ip)
         try:
-            async with self.session.post(
-                f'{ups["fetch_probes"]}://{ups["ip"]}:{ups["http_port"]}/Forms/login1',
+            async with ups.session.post(
+                f'{ups.fetch_probes}://{ups.ip}:{ups.http_port}/Forms/login1',
                 data={
                     'prefLanguage': '00000000',
-                    'login_username': ups['http_username'],
-                    'login_password': ups['http_password'],
+                    'login_username': ups.http_username,
+                    'login_password': ups.http_password,
                     'submit': 'Log On'
                 },
-                timeout=ups['timeout']
+                timeout=ups.http_timeout
             ) as resp:
                 if resp.status != 200:
-                    log.error(f'Failed to generate NMC session for UPS "{ups["name"]}" at IP "{ups["ip"]}": Got HTTP {resp.status} {resp.reason}')
+                    log.error('Failed to generate NMC session for UPS "%s" at IP "%s": Got HTTP %s %s', ups.name, ups.ip, resp.status, resp.reason)
                     return
                 # Get the session from the URL
-                session = self.nmc_session_regex.search(f'{resp.url}')
+                session = NMC_SESSION_REGEX.search(f'{resp.url}')
                 if session:
                     session = session.group(1)
-                    log.info(f'Generated NMC session "{session}" for UPS "{ups["name"]}" at IP "{ups["ip"]}"')
+                    log.info('Generated NMC session "%s" for UPS "%s" at IP "%s"', session, ups.name, ups.ip)
                 # No session in the URL, username or password is wrong
                 else:
-                    log.error(f'Failed to generate NMC session for UPS "{ups["name"]}" at IP "{ups["ip"]}": Invalid username or password')
+                    log.error('Failed to generate NMC session for UPS "%s" at IP "%s": Invalid username or password', ups.name, ups.ip)
                 return session
         except Exception as e:
-            log.error(f'Failed to generate NMC session for UPS "{ups["name"]}" at IP "{ups["ip"]}": "{e}"')
+            log.error('Failed to generate NMC session for UPS "%s" at IP "%s": "%s"', ups.name, ups.ip, e)
             return
 
-    async def fetch_ups(self, ups):
-        log.info(f'Starting fetch for UPS "{ups["name"]}" at IP "{ups["ip"]}"')
+    def _set_nmc_session(self, ups, session, save:bool=True):
+        """
+            Saves the NMC session for a UPS and rebuilds its uiostatus.htm URL
 
-        # List of OIDs to GETBULK
-        # Have to batch them since it exceeds the max packet size
-        oids = tuple([
-            '.1.3.6.1.4.1.318.1.1.1.1.2 .1.3.6.1.4.1.318.1.1.1.2.2 .1.3.6.1.4.1.318.1.1.1.2.3 .1.3.6.1.4.1.318.1.1.1.4.2 .1.3.6.1.4.1.318.1.1.1.1.1.1',
-            '.1.3.6.1.4.1.318.1.1.1.3.3 .1.3.6.1.4.1.318.1.1.1.4.3 .1.3.6.1.4.1.318.1.1.1.12.1 .1.3.6.1.4.1.318.1.1.1.5.2'
-        ])
-        probe_oid = tuple(['.1.3.6.1.4.1.318.1.1.25.1'])
+            The URL only changes with the session, so it's not rebuilt every fetch
+            Also saves the sessions to NMC_SESSION_FILE if it's set and the session changed
+        """
+        changed = session != ups.nmc_session
+        ups.nmc_session = session
+        ups.probe_url = f'{ups.fetch_probes}://{ups.ip}:{ups.http_port}/NMC/{session}/uiostatus.htm' if session is not None else None
+        if save and changed and self.nmc_session_file:
+            self._save_nmc_sessions()
+
+    async def fetch_probe_html(self, ups):
+        """
+            Fetches uiostatus.htm from the NMC web interface
+
+            Regenerates the NMC session if needed
+            Returns the raw HTML bytes or None if it couldn't be fetched
+        """
+        html = None
+        # Check if there's no NMC session
+        if ups.nmc_session is None:
+            # Try to generate a new NMC session
+            self._set_nmc_session(ups, await self.generate_nmc_session(ups))
+        else:
+            # We already have an NMC session
+            async with ups.session.get(ups.probe_url, timeout=ups.http_timeout) as resp:
+                if resp.status != 200:
+                    log.error('Failed to fetch HTTP probe data from UPS "%s" at IP "%s": Got HTTP status %s %s', ups.name, ups.ip, resp.status, resp.reason)
+                else:
+                    html = await resp.read()
+
+        # Check if there's no HTML or if we got redirected to the login page
+        # Assume the previous fetch failed (invalid NMC session?)
+        # Try to regenerate the NMC session and scrape again
+        if (html is None or PROBE_HTML_LOGIN_REGEX.search(html)) and (session := await self.generate_nmc_session(ups)) is not None:
+            # Update the NMC session
+            self._set_nmc_session(ups, session)
+            # Try to fetch again
+            async with ups.session.get(ups.probe_url, timeout=ups.http_timeout) as resp:
+                if resp.status != 200:
+                    log.error('Failed to refetch HTTP probe data from UPS "%s" at IP "%s": Got HTTP status %s %s', ups.name, ups.ip, resp.status, resp.reason)
+                else:
+                    html = await resp.read()
+
+        return html
+
+    async def fetch_ups(self, ups, delay:float=0):
+        # Wait before the first fetch so the UPSes aren't all fetched at the same time
+        await asyncio.sleep(delay)
+        log.info('Starting fetch for UPS "%s" at IP "%s"', ups.name, ups.ip)
+
+        deadline = self.loop.time()
         while True:
+            # Wait for the next fetch
+            # Fetches are scheduled from the previous deadline so the time spent fetching doesn't cause drift
+            now = self.loop.time()
+            if deadline > now:
+                await asyncio.sleep(deadline - now)
+            else:
+                # Fetch right away on the first fetch or if the last fetch overran the interval
+                deadline = now
+            deadline += ups.interval or self.fetch_interval
+
             try:
-                # Fetch the SNMP data
-                snmp_data = await self.fetch_snmp(
-                    ip=ups['ip'],
-                    version=ups['snmp_version'],
-                    oids=oids,
-                    community=ups['snmp_community'],
-                    username=ups['snmp_username'],
-                    password=ups['snmp_password'],
-                    port=ups['snmp_port'],
-                    timeout=ups['timeout']
-                )
+                # OID groups to fetch, including the probe OIDs if fetching probe data via SNMP
+                fetch_oids = [UPS_OIDS]
+                if ups.fetch_probes == 'snmp':
+                    fetch_oids.append(PROBE_OIDS)
+
+                # Fetch the SNMP data and probe data at the same time
+                # Limit how many UPSes are being fetched at once
+                async with self.fetch_semaphore:
+                    snmp_data, *probe_data = await asyncio.gather(*(
+                        self.fetch_snmp(ups, group) for group in fetch_oids
+                    ))
                 # Check if there was no data (failed to fetch)
                 if not snmp_data:
-                    log.error(f'Failed to fetch SNMP data from UPS "{ups["name"]}" at IP "{ups["ip"]}"')
-                    # Wait before retrying
-                    await asyncio.sleep(ups['interval'] or self.fetch_interval)
+                    log.error('Failed to fetch SNMP data from UPS "%s" at IP "%s"', ups.name, ups.ip)
+                    # Retry on the next fetch
                     continue
 
                 # Get the current UTC timestamp
-                timestamp = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
-                log.debug(f'Got snmp_data {snmp_data}')
+                timestamp = time.time()
+                log.debug('Got snmp_data %s', snmp_data)
 
-                data = [
-                    ups['name'], # Target/UPS name
-                    snmp_data.get('upsBasicIdentModel.0'), # upsBasicIdentModel.0 = "Smart-UPS X 2200"
-                    snmp_data.get('upsAdvIdentSkuNumber.0', ups['sku']), # upsAdvIdentSkuNumber.0 = "SMX2200RMLV2U"
-                    snmp_data.get('upsAdvConfigSensitivity.0'), # Sensitivity : auto(1), low(2), medium(3), high(4)
-                    snmp_data.get('upsBasicOutputStatus.0'), # Status : unknown(1), onLine(2), onBattery(3), onSmartBoost(4), timedSleeping(5), softwareBypass(6), off(7), rebooting(8), switchedBypass(9), hardwareFailureBypass(10), sleepingUntilPowerReturn(11), onSmartTrim(12)
-                    snmp_data.get('upsAdvInputLineFailCause.0'), # Last transfer reason : noTransfer(1), highLineVoltage(2), brownout(3), blackout(4), smallMomentarySag(5), deepMomentarySag(6), smallMomentarySpike(7), largeMomentarySpike(8), selfTest(9), rateOfVoltageChange(10)
-                    snmp_data.get('upsAdvBatteryReplaceIndicator.0') == 'batteryNeedsReplacing', # Battery replace indicator : noBatteryNeedsReplacing(1), batteryNeedsReplacing(2)
-                    snmp_data.get('upsBasicBatteryStatus.0'), # Battery status : unknown(1), batteryNormal(2), batteryLow(3)
-                ]
+                # Output watts and VA
+                output_load = snmp_data.get('upsHighPrecOutputLoad.0')
+                output_power = tuple(
+                    # Check if the UPS already has a value for this
+                    value if (value := snmp_data.get(key))
+                    # Older models don't have this, so try to calculate it ourselves from the output percent and the user supplied UPS rating
+                    else getattr(ups, rating) * (int(output_load) / 1000) if getattr(ups, rating) and output_load is not None
+                    # No rating, can't calculate the output
+                    else None
+                    for key, rating in OUTPUT_POWER_OIDS
+                )
 
-                # Output watts
-                # Check if the UPS already has a value for this
-                if snmp_data.get('upsAdvOutputActivePower.0'):
-                    data.append(snmp_data.get('upsAdvOutputActivePower.0'))
-                else:
-                    # Older models don't have this, so try to calculate it ourselves
-                    # Check if the user supplied the UPS rated watts
-                    if ups['rated_watts'] and snmp_data.get('upsHighPrecOutputLoad.0') is not None:
-                        # Calculate the output watts from the output percent and rated watts
-                        data.append(ups['rated_watts'] * (int(snmp_data['upsHighPrecOutputLoad.0']) / 1000))
-                    else:
-                        # No rated watts, can't calculate output watts
-                        data.append(None)
-                
-                # Output VA
-                # Check if the UPS already has a value for this
-                if snmp_data.get('upsAdvOutputApparentPower.0'):
-                    data.append(snmp_data.get('upsAdvOutputApparentPower.0'))
-                else:
-                    # Older models don't have this, so try to calculate it ourselves
-                    # Check if the user supplied the UPS rated VA
-                    if ups['rated_va'] and snmp_data.get('upsHighPrecOutputLoad.0') is not None:
-                        # Calculate the output VA from the output percent and rated VA
-                        data.append(ups['rated_va'] * (int(snmp_data['upsHighPrecOutputLoad.0']) / 1000))
-                    else:
-                        # No rated VA, can't calculate output VA
-                        data.append(None)
-                
                 # High precision data parsing
-                # Battery capacity : upsHighPrecBatteryCapacity.0 = 1000
-                if snmp_data.get('upsHighPrecBatteryCapacity.0'):
-                    data.append(float(snmp_data.get('upsHighPrecBatteryCapacity.0', 0.0)) / 10)
-                else:
-                    data.append(None)
-                
-                # Battery voltage : upsHighPrecBatteryActualVoltage.0 = 1330
-                if snmp_data.get('upsHighPrecBatteryActualVoltage.0'):
-                    data.append(float(snmp_data.get('upsHighPrecBatteryActualVoltage.0', 0.0)) / 10)
-                else:
-                    data.append(None)
-                                
-                # Input voltage : upsHighPrecInputLineVoltage.0 = 1190
-                if snmp_data.get('upsHighPrecInputLineVoltage.0'):
-                    data.append(float(snmp_data.get('upsHighPrecInputLineVoltage.0', 0.0)) / 10)
-                else:
-                    data.append(None)
-                
-                # Input frequency : upsHighPrecOutputVoltage.0 = 1191
-                if snmp_data.get('upsHighPrecInputFrequency.0'):
-                    data.append(float(snmp_data.get('upsHighPrecInputFrequency.0', 0.0)) / 10)
-                else:
-                    data.append(None)
-                
-                # Output voltage : 1196
-                if snmp_data.get('upsHighPrecOutputVoltage.0'):
-                    data.append(float(snmp_data.get('upsHighPrecOutputVoltage.0', 0.0)) / 10)
-                else:
-                    data.append(None)
-                
-                # Output frequency : upsHighPrecOutputFrequency.0 = 600
-                if snmp_data.get('upsHighPrecOutputFrequency.0'):
-                    data.append(float(snmp_data.get('upsHighPrecOutputFrequency.0', 0.0)) / 10)
-                else:
-                    data.append(None)
-                
-                # Output load percent : upsHighPrecOutputLoad.0 = 68
-                if snmp_data.get('upsHighPrecOutputLoad.0'):
-                    data.append(float(snmp_data.get('upsHighPrecOutputLoad.0', 0.0)) / 10)
-                else:
-                    data.append(None)
-                
-                # Output current amps : upsHighPrecOutputCurrent.0 = 12
-                if snmp_data.get('upsHighPrecOutputCurrent.0'):
-                    data.append(float(snmp_data.get('upsHighPrecOutputCurrent.0', 0.0)) / 10)
-                else:
-                    data.append(None)
-                
-                # Output efficiency percent : upsHighPrecOutputEfficiency.0 = -2
-                # This one is weird, it can go negative
-                if snmp_data.get('upsHighPrecOutputEfficiency.0'):
-                    data.append(max(0.0, float(snmp_data.get('upsHighPrecOutputEfficiency.0', 0.0)) / 10))
-                else:
-                    data.append(None)
-                
-                # Output energy usage kWh : upsHighPrecOutputEnergyUsage.0 = 340
-                if snmp_data.get('upsHighPrecOutputEnergyUsage.0'):
-                    data.append(float(snmp_data.get('upsHighPrecOutputEnergyUsage.0', 0.0)) / 100)
-                else:
-                    data.append(None)
+                high_precision = _scale_high_precision(snmp_data)
 
                 # Date parsing (usually "MM/DD/YYYY")
-                manufacture_date = snmp_data.get('upsAdvIdentDateOfManufacture.0')
-                if manufacture_date is not None:
-                    try:
-                        # Parse the date into a datetime.date object
-                        if len(manufacture_date) > 8:
-                            # upsAdvBatteryRecommendedReplaceDate.0 = "05/16/2027"
-                            manufacture_date = datetime.datetime.strptime(manufacture_date, '%m/%d/%Y').date()
-                        else:
-                            # upsAdvBatteryRecommendedReplaceDate.0 = "03/07/22"
-                            manufacture_date = datetime.datetime.strptime(manufacture_date, '%m/%d/%y').date()
-                    except ValueError:
-                        try:
-                            # Parse the date into a datetime.date object 
-                            manufacture_date = datetime.datetime.strptime(manufacture_date, '%m/%d/%Y').date()
-                        except ValueError:
-                            log.exception(f'Failed to parse upsAdvIdentDateOfManufacture.0 "{manufacture_date}"')
-                            manufacture_date = None
-
-                last_battery_replace_date = snmp_data.get('upsBasicBatteryLastReplaceDate.0')
-                if last_battery_replace_date is not None:
-                    try:
-                        # Parse the date into a datetime.date object
-                        if len(last_battery_replace_date) > 8:
-                            # upsAdvBatteryRecommendedReplaceDate.0 = "05/16/2027"
-                            last_battery_replace_date = datetime.datetime.strptime(last_battery_replace_date, '%m/%d/%Y').date()
-                        else:
-                            # upsAdvBatteryRecommendedReplaceDate.0 = "03/07/22"
-                            last_battery_replace_date = datetime.datetime.strptime(last_battery_replace_date, '%m/%d/%y').date()
-                    except ValueError:
-                        log.exception(f'Failed to parse upsBasicBatteryLastReplaceDate.0 "{last_battery_replace_date}"')
-                        last_battery_replace_date = None
-
-                next_battery_replace_date = snmp_data.get('upsAdvBatteryRecommendedReplaceDate.0')
-                if next_battery_replace_date is not None:
-                    try:
-                        # Parse the date into a datetime.date object
-                        if len(next_battery_replace_date) > 8:
-                            # upsAdvBatteryRecommendedReplaceDate.0 = "05/16/2027"
-                            next_battery_replace_date = datetime.datetime.strptime(next_battery_replace_date, '%m/%d/%Y').date()
-                        else:
-                            # upsAdvBatteryRecommendedReplaceDate.0 = "03/07/22"
-                            next_battery_replace_date = datetime.datetime.strptime(next_battery_replace_date, '%m/%d/%y').date()
-                    except ValueError:
-                        log.exception(f'Failed to parse upsAdvBatteryRecommendedReplaceDate.0 "{next_battery_replace_date}"')
-                        next_battery_replace_date = None
+                manufacture_date = _parse_apc_date('upsAdvIdentDateOfManufacture.0', snmp_data.get('upsAdvIdentDateOfManufacture.0'))
+                last_battery_replace_date = _parse_apc_date('upsBasicBatteryLastReplaceDate.0', snmp_data.get('upsBasicBatteryLastReplaceDate.0'))
+                next_battery_replace_date = _parse_apc_date('upsAdvBatteryRecommendedReplaceDate.0', snmp_data.get('upsAdvBatteryRecommendedReplaceDate.0'))
 
                 # Parse runtimes
-                runtime_remaining = snmp_data.get('upsAdvBatteryRunTimeRemaining.0')
-                if runtime_remaining is not None:
-                    # upsAdvBatteryRunTimeRemaining.0 = 0:3:01:24.00 (days:hours:minutes:seconds)
-                    days, hours, minutes, seconds = runtime_remaining.split(':')
-                    runtime_remaining = (int(days) * 86400) + (int(hours) * 3600) + (int(minutes) * 60) + int(seconds[:2])
-                
-                on_battery = snmp_data.get('upsBasicBatteryTimeOnBattery.0')
-                if on_battery is not None:
-                    # upsBasicBatteryTimeOnBattery.0 = 0:0:00:00.00 (days:hours:minutes:seconds)
-                    days, hours, minutes, seconds = on_battery.split(':')
-                    on_battery = (int(days) * 86400) + (int(hours) * 3600) + (int(minutes) * 60) + int(seconds[:2])
+                # upsAdvBatteryRunTimeRemaining.0 = 0:3:01:24.00 (days:hours:minutes:seconds)
+                runtime_remaining = _parse_timeticks(snmp_data.get('upsAdvBatteryRunTimeRemaining.0'))
+                # upsBasicBatteryTimeOnBattery.0 = 0:0:00:00.00 (days:hours:minutes:seconds)
+                on_battery = _parse_timeticks(snmp_data.get('upsBasicBatteryTimeOnBattery.0'))
 
                 probes = {}
                 sensor_name = []
                 sensor_value = []
 
                 # Battery temperature sensor : upsHighPrecExtdBatteryTemperature.0 = 206
-                if snmp_data.get('upsHighPrecExtdBatteryTemperature.0') is not None:
+                if (battery_temperature := snmp_data.get('upsHighPrecExtdBatteryTemperature.0')) is not None:
                     sensor_name.append('Battery Temperature')
-                    sensor_value.append(float(snmp_data['upsHighPrecExtdBatteryTemperature.0']) / 10)
+                    sensor_value.append(float(battery_temperature) / 10)
 
                 # Fetch probe data via SNMP 
                 # SNMP probe data returns whole numbers only
-                if ups['fetch_probes'] == 'snmp':
-                    # Fetch the SNMP data
-                    snmp_data = await self.fetch_snmp(
-                        ip=ups['ip'],
-                        version=ups['snmp_version'],
-                        oids=probe_oid,
-                        community=ups['snmp_community'],
-                        username=ups['snmp_username'],
-                        password=ups['snmp_password'],
-                        port=ups['snmp_port'],
-                        timeout=ups['timeout']
-                    )
+                if ups.fetch_probes == 'snmp':
+                    # Probe data was fetched alongside the SNMP data
+                    probe_data = probe_data[0]
                     # Check if there was no data (failed to fetch)
-                    if not snmp_data:
-                        log.error(f'Failed to fetch SNMP probe data from UPS "{ups["name"]}" at IP "{ups["ip"]}"')
+                    if not probe_data:
+                        log.error('Failed to fetch SNMP probe data from UPS "%s" at IP "%s"', ups.name, ups.ip)
                     
                     # Parse the probe data
-                    for probe in snmp_data.keys():
+                    for probe, value in probe_data.items():
                         # Get the probe ID
                         probe_id = probe.split('.')[-1]
-                        value = snmp_data[probe]
                         # Probe name
                         if probe.startswith('uioSensorStatusSensorName'):
                             probes[probe_id] = value
@@ -583,59 +897,48 @@ class APC:
 
                 # Fetch probe data via scraping uiostatus.htm
                 # We get more precise data this way (0.5C increments)
-                elif ups['fetch_probes'] in ('http', 'https'):
-                    html = None
-                    # Check if there's no NMC session
-                    if ups['nmc_session'] is None:
-                        # Try to generate a new NMC session
-                        ups['nmc_session'] = await self.generate_nmc_session(ups)
-                    else:
-                        # We already have an NMC session
-                        async with self.session.get(
-                            f'{ups["fetch_probes"]}://{ups["ip"]}:{ups["http_port"]}/NMC/{ups["nmc_session"]}/uiostatus.htm',
-                            timeout=ups['timeout']
-                        ) as resp:
-                            if resp.status != 200:
-                                log.error(f'Failed to fetch HTTP probe data from UPS "{ups["name"]}" at IP "{ups["ip"]}": Got HTTP status {resp.status} {resp.reason}')
-                            else:
-                                html = await resp.text()
-
-                    # Check if there's no HTML or if we got redirected to the login page
-                    # Assume the previous fetch failed (invalid NMC session?)
-                    # Try to regenerate the NMC session and scrape again
-                    if (html is None or self.probe_html_login_regex.search(html)) and (session := await self.generate_nmc_session(ups)) is not None:
-                        # Update the NMC session
-                        ups['nmc_session'] = session
-                        # Try to fetch again
-                        async with self.session.get(
-                            f'{ups["fetch_probes"]}://{ups["ip"]}:{ups["http_port"]}/NMC/{ups["nmc_session"]}/uiostatus.htm',
-                            timeout=ups['timeout']
-                        ) as resp:
-                            if resp.status != 200:
-                                log.error(f'Failed to refetch HTTP probe data from UPS "{ups["name"]}" at IP "{ups["ip"]}": Got HTTP status {resp.status} {resp.reason}')
-                            else:
-                                html = await resp.text()
+                elif ups.fetch_probes in ('http', 'https'):
+                    # Limit how many UPSes are being fetched at once
+                    async with self.fetch_semaphore:
+                        html = await self.fetch_probe_html(ups)
 
                     # Check if we were able to scrape the page
                     if html:
-                        probes = self.probe_html_regex.findall(html)
-                        log.debug(f'Got HTML probes for {ups["ip"]} {probes}')
-
-                        for probe in probes:
-                            sensor_name.append(f'{probe[0]} Temperature')
-                            # Check if the temperature is in Fahrenheit
-                            if probe[2] == 'F':
-                                # Convert to Celsius
-                                sensor_value.append((float(probe[1]) - 32) * 5 / 9)
-                            # Temperature is in Celsius
-                            else:
-                                sensor_value.append(float(probe[1]))
+                        # Parse big pages in a thread so they don't stall the other fetchers
+                        # Small pages parse faster than the thread handoff, so keep them on the loop
+                        if len(html) >= PROBE_HTML_EXECUTOR_SIZE:
+                            probes = await self.loop.run_in_executor(None, _parse_probe_html, html)
+                        else:
+                            probes = _parse_probe_html(html)
+
+                    # Skip the probe handling if the UPS has no probes
+                    if probes:
+                        # Only format the probes if they'll be logged
+                        if log.isEnabledFor(logging.DEBUG):
+                            log.debug('Got HTML probes for %s %r', ups.ip, probes)
+
+                        for name, temperature, unit, humidity in probes:
+                            sensor_name.append(f'{name} Temperature')
+                            # Convert the temperature to Celsius
+                            offset, multiplier, divisor = TEMPERATURE_TO_CELSIUS[unit]
+                            sensor_value.append((float(temperature) - offset) * multiplier / divisor)
                             # Check if the probe has humidity data
-                            if probe[3] != '':
-                                sensor_name.append(f'{probe[0]} Humidity')
-                                sensor_value.append(float(probe[3]))
+                            if humidity:
+                                sensor_name.append(f'{name} Humidity')
+                                sensor_value.append(float(humidity))
 
-                data.extend((
+                # Build the row in one go, in the same order as the INSERT query columns
+                data = (
+                    ups.name, # Target/UPS name
+                    snmp_data.get('upsBasicIdentModel.0'), # upsBasicIdentModel.0 = "Smart-UPS X 2200"
+                    snmp_data.get('upsAdvIdentSkuNumber.0', ups.sku), # upsAdvIdentSkuNumber.0 = "SMX2200RMLV2U"
+                    snmp_data.get('upsAdvConfigSensitivity.0'), # Sensitivity : auto(1), low(2), medium(3), high(4)
+                    snmp_data.get('upsBasicOutputStatus.0'), # Status : unknown(1), onLine(2), onBattery(3), onSmartBoost(4), timedSleeping(5), softwareBypass(6), off(7), rebooting(8), switchedBypass(9), hardwareFailureBypass(10), sleepingUntilPowerReturn(11), onSmartTrim(12)
+                    snmp_data.get('upsAdvInputLineFailCause.0'), # Last transfer reason : noTransfer(1), highLineVoltage(2), brownout(3), blackout(4), smallMomentarySag(5), deepMomentarySag(6), smallMomentarySpike(7), largeMomentarySpike(8), selfTest(9), rateOfVoltageChange(10)
+                    snmp_data.get('upsAdvBatteryReplaceIndicator.0') == 'batteryNeedsReplacing', # Battery replace indicator : noBatteryNeedsReplacing(1), batteryNeedsReplacing(2)
+                    snmp_data.get('upsBasicBatteryStatus.0'), # Battery status : unknown(1), batteryNormal(2), batteryLow(3)
+                    *output_power, # Output watts and VA
+                    *high_precision, # High precision values in HIGH_PRECISION_OIDS order
                     manufacture_date,
                     last_battery_replace_date,
                     next_battery_replace_date,
@@ -644,26 +947,40 @@ class APC:
                     sensor_name,
                     sensor_value,
                     timestamp
-                ))
+                )
 
-                self.clickhouse_queue.put_nowait(data)
+                await self.clickhouse_queue.put(data)
             except Exception:
-                log.exception(f'Failed to fetch UPS target "{ups["name"]}" at IP "{ups["ip"]}"')
-            finally:
-                # Wait the configured interval before fetching again
-                await asyncio.sleep(ups['interval'] or self.fetch_interval)
+                log.exception('Failed to fetch UPS target "%s" at IP "%s"', ups.name, ups.ip)
 
     async def run(self):
         """
             Setup and run the exporter
         """
+        # Set the event to stop the loop on SIGTERM
+        # Handled by the event loop so the event is set from the loop's thread
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop_event.set)
+
         # Load the UPS targets from targets.json
         self._load_targets()
         if not self.ups_targets:
             log.error('No valid UPS targets found in targets.json')
             exit(1)
 
-        # Create a ClientSession that doesn't verify SSL certificates
+        # Create a ClientSession per UPS for fetching HTTP probe data
+        # Each NMC gets its own kept-alive connection so we don't redo the TCP/TLS handshake every fetch
+        for ups in self.ups_targets:
+            if ups.fetch_probes in ('http', 'https'):
+                ups.session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(
+                        limit=1,
+                        # Keep the connection open across fetches, with plenty of headroom for slow fetches
+                        keepalive_timeout=max(60, (ups.interval or self.fetch_interval) * 3),
+                        ssl=self.nmc_ssl_context
+                    )
+                )
+
+        # Create a ClientSession for ClickHouse that doesn't verify SSL certificates
         self.session = aiohttp.ClientSession(
             connector=aiohttp.TCPConnector(ssl=False)
         )
@@ -674,38 +991,51 @@ class APC:
             user=self.clickhouse_user,
             password=self.clickhouse_pass,
             database=self.clickhouse_db,
-            json=json
+            json=orjson,
+            # Have ClickHouse gzip its responses
+            compress_response=True,
+            # Let ClickHouse buffer the inserts server-side
+            async_insert=1,
+            wait_for_async_insert=1
         )
-        log.debug(f'Using ClickHouse table "{self.clickhouse_table}" at "{self.clickhouse_url}"')
+        # Bind the execute method once instead of looking it up on every insert
+        self.clickhouse_execute = self.clickhouse.execute
+        log.debug('Using ClickHouse table "%s" at "%s"', self.clickhouse_table, self.clickhouse_url)
 
         # Run the queue inserter as a task
-        asyncio.create_task(self.insert_to_clickhouse())
+        inserter = asyncio.create_task(self.insert_to_clickhouse())
 
-        for ups in self.ups_targets:
-            # Run the fetcher as a task
-            log.debug(f'Creating task for UPS {ups}')
-            asyncio.create_task(self.fetch_ups(ups))
+        async with asyncio.TaskGroup() as task_group:
+            fetchers = []
+            for i, ups in enumerate(self.ups_targets):
+                # Run the fetcher as a task
+                # Spread the first fetches evenly across the fetch interval
+                delay = (ups.interval or self.fetch_interval) * i / len(self.ups_targets)
+                log.debug('Creating task for UPS %s starting in %.2fs', ups, delay)
+                fetchers.append(task_group.create_task(self.fetch_ups(ups, delay)))
 
-        # Run forever or until we get SIGTERM'd
-        await self.stop_event.wait()
+            # Run forever or until we get SIGTERM'd
+            await self.stop_event.wait()
 
-        log.info('Exiting...')
-        # Close the ClientSession
+            log.info('Exiting...')
+            # Stop the fetchers
+            for fetcher in fetchers:
+                fetcher.cancel()
+
+        # Stop queueing data and insert whatever is left
+        self.clickhouse_queue.close()
+        await inserter
+        # Close the ClientSessions
         await self.session.close()
+        for ups in self.ups_targets:
+            if ups.session is not None:
+                await ups.session.close()
         # Close the ClickHouse client
         await self.clickhouse.close()
 
 
-loop = asyncio.new_event_loop()
-apc = APC(loop)
-
-def sigterm_handler(_signo, _stack_frame):
-    """
-        Handle SIGTERM
-    """
-    # Set the event to stop the loop
-    apc.stop_event.set()
-# Register the SIGTERM handler
-signal.signal(signal.SIGTERM, sigterm_handler)
-
-loop.run_until_complete(apc.run())
\ No newline at end of file
+# Only run the exporter when started directly, so the parsers can be imported by the tests
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    apc = APC(loop)
+    loop.run_until_complete(apc.run())
@@ -0,0 +1,100 @@
+"""
+    Parity check between _parse_probe_html and the probe regex it replaced
+
+    Run from the repo root with: python -m unittest discover tests
+"""
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import apc
+
+# The uiostatus.htm probe regex _parse_probe_html replaced, unchanged
+PROBE_HTML_REGEX = re.compile(
+    r'<a href=\"uiocfg\.htm\?sensor=[\d]{1}\" alt=\"Edit\" title=\"Edit\">([^<]*)</a></td>\r\n<td><span class=\"se-icon-f4-selection text-success\"></span>&nbsp;Normal</td>\r\n<td>([^&]*)&deg;&nbsp;(F|C)</td>\r\n<td>(?:([\d]{1,2})%&nbsp;RH|Not Available)</td>\r\n</tr>\r\n(?=<tr>|</table>\n</div>\n</div>\n<div class=\"dataSection\">\n<div class=\"dataSubHeader\">\n<span id=\"langInputContacts\">)'
+)
+
+# Trimmed uiostatus.htm with the probe table markup the regex matches
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uiostatus.htm')
+
+# Extra probe row appended to the fixture's table
+EXTRA_ROW = (
+    '<tr>\r\n'
+    '<td><a href="uiocfg.htm?sensor={sensor}" alt="Edit" title="Edit">Port 3 Temp 1</a></td>\r\n'
+    '<td><span class="se-icon-f4-selection text-success"></span>&nbsp;Normal</td>\r\n'
+    '<td>{temperature}</td>\r\n'
+    '<td>{humidity}</td>\r\n'
+    '</tr>\r\n'
+)
+
+
+def _read_fixture():
+    # Keep the \r\n line endings the markup depends on
+    with open(FIXTURE, 'r', newline='') as file:
+        return file.read()
+
+
+def _scan(html):
+    # The scanner works on the raw page bytes, decode what it returns to compare with the regex
+    return [
+        (name, temperature.decode(), unit.decode(), humidity.decode())
+        for name, temperature, unit, humidity in apc._parse_probe_html(html.encode())
+    ]
+
+
+def _add_row(html, sensor='2', temperature='68.0&deg;&nbsp;F', humidity='35%&nbsp;RH'):
+    return html.replace('</table>', EXTRA_ROW.format(sensor=sensor, temperature=temperature, humidity=humidity) + '</table>')
+
+
+class ProbeHTMLParityTest(unittest.TestCase):
+    def setUp(self):
+        self.html = _read_fixture()
+
+    def assertParity(self, html):
+        self.assertEqual(_scan(html), PROBE_HTML_REGEX.findall(html))
+
+    def test_fixture(self):
+        self.assertEqual(_scan(self.html), [
+            ('Port 1 Temp 1', '70.5', 'F', '40'),
+            ('Port 2 Temp 1', '19.5', 'C', ''),
+        ])
+        self.assertParity(self.html)
+
+    def test_variants(self):
+        first_status = '<span class="se-icon-f4-selection text-success"></span>&nbsp;Normal'
+        variants = {
+            'first temperature not available': self.html.replace('70.5&deg;&nbsp;F', 'Not Available', 1),
+            'second temperature not available': self.html.replace('19.5&deg;&nbsp;C', 'Not Available'),
+            'humidity 100': self.html.replace('40%&nbsp;RH', '100%&nbsp;RH'),
+            'humidity 0': self.html.replace('40%&nbsp;RH', '0%&nbsp;RH'),
+            'first probe not normal': self.html.replace(first_status, '<span class="se-icon-f4-selection text-danger"></span>&nbsp;Critical', 1),
+            'negative temperature': self.html.replace('19.5&deg;', '-3.5&deg;'),
+            'third probe': _add_row(self.html),
+            'third probe without readings': _add_row(self.html, temperature='Not Available', humidity='Not Available'),
+            'no probes': self.html.replace('<tr>', '<tr class="x">').replace('uiocfg.htm', 'other.htm'),
+        }
+        for name, html in variants.items():
+            with self.subTest(name):
+                self.assertParity(html)
+
+    def test_intentional_differences(self):
+        # Multi digit sensor indexes are kept, the regex only matched sensor=0-9
+        html = _add_row(self.html, sensor='10')
+        self.assertEqual(_scan(html)[-1], ('Port 3 Temp 1', '68.0', 'F', '35'))
+        self.assertNotIn(('Port 3 Temp 1', '68.0', 'F', '35'), PROBE_HTML_REGEX.findall(html))
+
+        # Non numeric temperatures are skipped, the regex returned them and float() failed on them later
+        html = self.html.replace('70.5&deg;', 'n/a&deg;')
+        self.assertEqual(_scan(html), [('Port 2 Temp 1', '19.5', 'C', '')])
+        self.assertIn(('Port 1 Temp 1', 'n/a', 'F', '40'), PROBE_HTML_REGEX.findall(html))
+
+        # The last probe is kept on a page cut off after the table, the regex needed the markup that follows it
+        html = self.html.split('</table>')[0]
+        self.assertEqual(_scan(html), [('Port 1 Temp 1', '70.5', 'F', '40'), ('Port 2 Temp 1', '19.5', 'C', '')])
+        self.assertEqual(PROBE_HTML_REGEX.findall(html), [('Port 1 Temp 1', '70.5', 'F', '40')])
+
+
+if __name__ == '__main__':
+    unittest.main()